@@ -7,52 +7,271 @@ y generación de estadísticas básicas para preparar los datos de ML.
 - Añade columna 'session_file' con el nombre del fichero de origen
 - Se asegura de que exista la columna 'PC' (si no, la crea asumiendo PC=1)
 - Guarda:
-    - spotify_dataset/spotify_merged_dataset.csv
+    - spotify_dataset/spotify_merged_dataset.parquet (columnar, zstd)
     - spotify_dataset/spotify_merged_summary.txt
+    - spotify_dataset/spotify_merged_dataset.csv (solo con --csv)
+
+Para cargar el dataset unificado:
+    pd.read_parquet(path, columns=[...], memory_map=True)
 """
 
 import os
 import glob
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    import duckdb
+except ImportError:  # duckdb es opcional: sin él los agregados se hacen con numpy
+    duckdb = None
 
 DATA_DIR = "spotify_dataset"
 OUTPUT_CSV = "spotify_merged_dataset.csv"
+OUTPUT_PARQUET = "spotify_merged_dataset.parquet"
 OUTPUT_SUMMARY = "spotify_merged_summary.txt"
 
-
-def load_and_merge(data_dir: str) -> pd.DataFrame:
+# Esquema de los CSV de captura: evita la inferencia de tipos por fichero.
+# Las columnas que no aparecen aquí se descartan al leer.
+# seq/ack/ttl/is_spotify_tls pueden venir vacíos (p.ej. ack_num=None en las
+# capturas antiguas): se usan tipos nulables para no descartar el fichero.
+DTYPES = {
+    "timestamp": "float64",
+    "quality_setting": "category",
+    "expected_bitrate": "float32",
+    "protocol": "category",
+    "length": "int32",
+    "PC": "int8",
+    "src_port": "uint16",
+    "dst_port": "uint16",
+    "tcp_flags": "category",
+    "seq_num": "UInt32",
+    "ack_num": "UInt32",
+    "src_ip": "category",
+    "dst_ip": "category",
+    "ttl": "UInt8",
+    "is_spotify_tls": "boolean",
+    "tls_record_length": "float32",
+    "iat": "float64",
+    "second": "int64",
+    "throughput_kbps": "float64",
+}
+
+DESCRIBE_INDEX = ["count", "mean", "std", "min", "25%", "50%", "75%", "max"]
+
+
+def _read_one(f: str):
+    """
+    Lee un CSV de captura; devuelve None si no se puede leer
+    """
+    try:
+        df = pd.read_csv(
+            f,
+            dtype=DTYPES,
+            usecols=lambda c: c in DTYPES,
+            engine="c",
+            low_memory=False,
+            # El parser lee directamente del fichero mapeado en memoria
+            memory_map=True,
+        )
+
+        # Añadimos columna con el nombre del fichero (identificador de sesión).
+        # Categórica: un único valor en el diccionario y códigos int8 por fila
+        df["session_file"] = pd.Categorical.from_codes(
+            np.zeros(len(df), dtype=np.int8), categories=[os.path.basename(f)]
+        )
+
+        # Si no existía la columna PC (capturas antiguas), asumimos PC=1 (porque vienen de la VM)
+        if "PC" not in df.columns:
+            df["PC"] = np.int8(1)
+
+        return df
+    except Exception as e:
+        print(f"[!] Error leyendo {f}: {e}")
+        return None
+
+
+def _align_categoricals(dfs: list) -> None:
+    """
+    Da a cada columna categórica las mismas categorías en todos los DataFrames,
+    para que las tablas Arrow compartan esquema y diccionario al concatenarlas
+    """
+    cat_cols = {col for df in dfs for col in df.columns
+                if isinstance(df[col].dtype, pd.CategoricalDtype)}
+    for col in cat_cols:
+        categories = None
+        for df in dfs:
+            if col in df.columns:
+                cats = df[col].cat.categories
+                categories = cats if categories is None else categories.union(cats)
+        for df in dfs:
+            if col in df.columns:
+                df[col] = df[col].cat.set_categories(categories)
+
+
+def load_and_merge(data_dir: str) -> pa.Table:
     pattern = os.path.join(data_dir, "*.csv")
-    files = sorted(glob.glob(pattern))
+    # El volcado CSV del propio merge (--csv) no es una captura
+    files = sorted(f for f in glob.glob(pattern) if os.path.basename(f) != OUTPUT_CSV)
 
     if not files:
         raise FileNotFoundError(f"No se han encontrado CSV en {data_dir}")
 
-    dfs = []
     print("Ficheros encontrados:")
     for f in files:
         print(f"  - {os.path.basename(f)}")
-        try:
-            df = pd.read_csv(f)
-
-            # Añadimos columna con el nombre del fichero (identificador de sesión)
-            df["session_file"] = os.path.basename(f)
-
-            # Si no existía la columna PC (capturas antiguas), asumimos PC=1 (porque vienen de la VM)
-            if "PC" not in df.columns:
-                df["PC"] = 1
 
-            dfs.append(df)
-        except Exception as e:
-            print(f"[!] Error leyendo {f}: {e}")
+    # El parser C de pandas libera el GIL: leemos los ficheros en paralelo.
+    # ex.map conserva el orden de 'files'.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        dfs = [df for df in ex.map(_read_one, files) if df is not None]
 
     if not dfs:
         raise RuntimeError("No se ha podido cargar ningún CSV correctamente")
 
-    merged = pd.concat(dfs, ignore_index=True)
+    # Concatenación en Arrow: reutiliza los buffers de cada tabla en lugar de
+    # copiar todas las columnas como pd.concat
+    _align_categoricals(dfs)
+    # Mismo orden de columnas en todas las tablas (select no copia datos)
+    columns = list(DTYPES) + ["session_file"]
+    tables = [
+        pa.Table.from_pandas(df, preserve_index=False).select([c for c in columns if c in df.columns])
+        for df in dfs
+    ]
+    # Con los esquemas ya idénticos la promoción no necesita convertir nada;
+    # solo actúa si a algún fichero le falta una columna
+    merged = pa.concat_tables(tables, promote_options="permissive")
     return merged
 
 
-def compute_summary(df: pd.DataFrame, out_path: str):
+def _describe(values: np.ndarray) -> list:
+    """
+    Equivalente a Series.describe() sobre un ndarray numérico (una pasada por estadística)
+    """
+    values = values[~np.isnan(values)]
+    n = len(values)
+    if n == 0:
+        return [0.0] + [np.nan] * 7
+
+    q25, q50, q75 = np.percentile(values, [25, 50, 75])
+    std = values.std(ddof=1) if n > 1 else np.nan
+    return [float(n), values.mean(), std, values.min(), q25, q50, q75, values.max()]
+
+
+def _value_counts(col: pd.Series, dropna: bool = True) -> pd.Series:
+    """
+    Equivalente a Series.value_counts() usando pd.factorize + np.bincount
+    """
+    codes, uniques = pd.factorize(col, use_na_sentinel=dropna)
+    if dropna:
+        codes = codes[codes >= 0]
+    counts = np.bincount(codes, minlength=len(uniques))
+    order = np.argsort(-counts, kind="stable")
+    return pd.Series(counts[order], index=pd.Index(uniques[order], name=col.name), name="count")
+
+
+def _top_n(col: pd.Series, n: int = 10) -> pd.Series:
+    """
+    Equivalente a Series.value_counts().head(n) sin ordenar todos los valores:
+    np.argpartition selecciona los n mayores en O(U) y solo esos se ordenan
+    """
+    codes, uniques = pd.factorize(col)
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    if len(counts) > n:
+        # Todos los empatados con el n-ésimo entran como candidatos, para que
+        # el desempate no dependa de argpartition
+        kth = np.partition(counts, len(counts) - n)[len(counts) - n]
+        top = np.flatnonzero(counts >= kth)
+    else:
+        top = np.arange(len(counts))
+    # Orden por frecuencia; a igualdad, por orden de aparición (como value_counts).
+    # factorize numera los valores por orden de aparición.
+    top = top[np.lexsort((top, -counts[top]))][:n]
+    return pd.Series(counts[top], index=pd.Index(uniques[top], name=col.name), name="count")
+
+
+def _describe_by(df: pd.DataFrame, key: str, col: str) -> pd.DataFrame:
+    """
+    Equivalente a df.groupby(key)[col].describe()
+    """
+    codes, uniques = pd.factorize(df[key])
+    # Orden por valor (como groupby), también si la columna es categórica
+    order = np.argsort(np.asarray(uniques, dtype=object))
+    values = df[col].to_numpy(dtype=np.float64)
+    rows = [_describe(values[codes == i]) for i in order]
+    return pd.DataFrame(rows, index=pd.Index(np.asarray(uniques, dtype=object)[order], name=key),
+                        columns=DESCRIBE_INDEX)
+
+
+def _describe_by_sql(con, key: str, col: str) -> pd.DataFrame:
+    """
+    Equivalente a df.groupby(key)[col].describe() ejecutado en DuckDB
+    """
+    rows = con.execute(f"""
+        SELECT "{key}",
+               count("{col}")::DOUBLE,
+               avg("{col}"),
+               stddev_samp("{col}"),
+               min("{col}"),
+               quantile_cont("{col}", 0.25),
+               quantile_cont("{col}", 0.5),
+               quantile_cont("{col}", 0.75),
+               max("{col}")
+        FROM t
+        WHERE "{key}" IS NOT NULL
+        GROUP BY "{key}"
+        ORDER BY "{key}"
+    """).fetchall()
+    index = pd.Index([r[0] for r in rows], name=key)
+    return pd.DataFrame([r[1:] for r in rows], index=index, columns=DESCRIBE_INDEX, dtype=np.float64)
+
+
+def _top_n_sql(con, col: str, n: int = 10) -> pd.Series:
+    """
+    Equivalente a Series.value_counts().head(n) ejecutado en DuckDB
+    (mismo desempate que _top_n: por orden de aparición)
+    """
+    rows = con.execute(f"""
+        SELECT "{col}", count(*) AS c
+        FROM t
+        WHERE "{col}" IS NOT NULL
+        GROUP BY "{col}"
+        ORDER BY c DESC, min(file_row_number)
+        LIMIT {int(n)}
+    """).fetchall()
+    index = pd.Index([r[0] for r in rows], name=col)
+    return pd.Series([r[1] for r in rows], index=index, name="count")
+
+
+def compute_summary(df: pd.DataFrame, out_path: str, parquet_path: str = None):
+    # Si hay Parquet y DuckDB, los agregados por grupo se calculan en DuckDB
+    # (motor vectorizado y paralelo leyendo directamente las columnas)
+    con = None
+    if parquet_path is not None and duckdb is not None:
+        con = duckdb.connect()
+        # file_row_number permite desempatar por orden de aparición, como en numpy
+        con.read_parquet(parquet_path, file_row_number=True).create_view("t")
+
+    # Una sola pasada por columna: nulos y estadísticas numéricas
+    nulls = {}
+    numeric_stats = {}
+    for col in df.columns:
+        s = df[col]
+        if pd.api.types.is_float_dtype(s):
+            values = s.to_numpy()
+            nulls[col] = int(np.isnan(values).sum())
+        else:
+            values = None
+            nulls[col] = int(s.isna().sum())
+
+        if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+            if values is None:
+                values = s.to_numpy(dtype=np.float64, na_value=np.nan)
+            numeric_stats[col] = _describe(values.astype(np.float64, copy=False))
+
     with open(out_path, "w") as f:
         f.write("=== RESUMEN GLOBAL DATASET SPOTIFY ===\n\n")
 
@@ -69,82 +288,100 @@ def compute_summary(df: pd.DataFrame, out_path: str):
         # Distribución por calidad
         if "quality_setting" in df.columns:
             f.write("=== Distribución por calidad (quality_setting) ===\n")
-            f.write(df["quality_setting"].value_counts(dropna=False).to_string())
+            f.write(_value_counts(df["quality_setting"], dropna=False).to_string())
             f.write("\n\n")
 
         # Distribución por PC/Mobile
         if "PC" in df.columns:
             f.write("=== Distribución por dispositivo (PC=1, Mobile=0) ===\n")
-            f.write(df["PC"].value_counts(dropna=False).to_string())
+            f.write(_value_counts(df["PC"], dropna=False).to_string())
             f.write("\n\n")
 
         # Sesiones (ficheros)
         if "session_file" in df.columns:
             f.write("=== Número de filas por fichero de captura (session_file) ===\n")
-            counts_by_file = df["session_file"].value_counts()
+            counts_by_file = _value_counts(df["session_file"])
             f.write(counts_by_file.to_string())
             f.write("\n\n")
 
         # Valores nulos
         f.write("=== Valores nulos por columna ===\n")
-        nulls = df.isna().sum()
-        f.write(nulls.to_string())
+        f.write(pd.Series(nulls).to_string())
         f.write("\n\n")
 
         # Describe de columnas numéricas
         f.write("=== Estadísticas numéricas globales ===\n")
-        numeric_desc = df.describe(include="number")
+        numeric_desc = pd.DataFrame(numeric_stats, index=DESCRIBE_INDEX)
         f.write(numeric_desc.to_string())
         f.write("\n\n")
 
         # Throughput por calidad (si existe)
         if "throughput_kbps" in df.columns and "quality_setting" in df.columns:
             f.write("=== Throughput_kbps por calidad (describe) ===\n")
-            thr_by_quality = df.groupby("quality_setting")["throughput_kbps"].describe()
+            thr_by_quality = (_describe_by_sql(con, "quality_setting", "throughput_kbps") if con
+                              else _describe_by(df, "quality_setting", "throughput_kbps"))
             f.write(thr_by_quality.to_string())
             f.write("\n\n")
 
         # IAT por calidad (si existe)
         if "iat" in df.columns and "quality_setting" in df.columns:
             f.write("=== IAT (Inter-Arrival Time) por calidad (describe) ===\n")
-            iat_by_quality = df.groupby("quality_setting")["iat"].describe()
+            iat_by_quality = (_describe_by_sql(con, "quality_setting", "iat") if con
+                              else _describe_by(df, "quality_setting", "iat"))
             f.write(iat_by_quality.to_string())
             f.write("\n\n")
 
         # Top destinos (para ver si hay “ruido” de muchas IPs distintas)
         if "dst_ip" in df.columns:
             f.write("=== Top 10 IPs destino (dst_ip) por número de paquetes ===\n")
-            dst_counts = df["dst_ip"].value_counts().head(10)
+            dst_counts = _top_n_sql(con, "dst_ip") if con else _top_n(df["dst_ip"])
             f.write(dst_counts.to_string())
             f.write("\n\n")
 
         if "src_ip" in df.columns:
             f.write("=== Top 10 IPs origen (src_ip) por número de paquetes ===\n")
-            src_counts = df["src_ip"].value_counts().head(10)
+            src_counts = _top_n_sql(con, "src_ip") if con else _top_n(df["src_ip"])
             f.write(src_counts.to_string())
             f.write("\n\n")
 
         f.write("=== Fin del resumen ===\n")
 
+    if con is not None:
+        con.close()
+
     print(f"✓ Resumen guardado en: {out_path}")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Merge de las capturas de spotify_dataset/")
+    parser.add_argument("--csv", action="store_true",
+                        help=f"guardar también {OUTPUT_CSV}")
+    args = parser.parse_args()
+
     base_dir = os.path.dirname(os.path.abspath(__file__))
     data_dir = os.path.join(base_dir, DATA_DIR)
 
     print(f"Directorio de datos: {data_dir}")
     merged = load_and_merge(data_dir)
 
-    # Guardar dataset unificado
-    out_csv_path = os.path.join(data_dir, OUTPUT_CSV)
-    merged.to_csv(out_csv_path, index=False)
-    print(f"✓ Dataset unificado guardado en: {out_csv_path}")
-    print(f"  Total filas: {len(merged)}")
+    # Guardar dataset unificado (directamente desde la tabla Arrow)
+    out_parquet_path = os.path.join(data_dir, OUTPUT_PARQUET)
+    pq.write_table(merged, out_parquet_path, compression="zstd")
+    print(f"✓ Dataset unificado guardado en: {out_parquet_path}")
+    print(f"  Total filas: {merged.num_rows}")
+
+    # El resumen y el volcado CSV trabajan sobre pandas; self_destruct libera
+    # los buffers Arrow a medida que se convierten
+    merged = merged.to_pandas(self_destruct=True)
+
+    if args.csv:
+        out_csv_path = os.path.join(data_dir, OUTPUT_CSV)
+        merged.to_csv(out_csv_path, index=False)
+        print(f"✓ Copia CSV guardada en: {out_csv_path}")
 
     # Generar resumen
     out_summary_path = os.path.join(data_dir, OUTPUT_SUMMARY)
-    compute_summary(merged, out_summary_path)
+    compute_summary(merged, out_summary_path, parquet_path=out_parquet_path)
 
 
 if __name__ == "__main__":
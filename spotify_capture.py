@@ -7,17 +7,129 @@ Añadido:
 - Columna 'PC': 1 si la captura es desde PC/VM, 0 si es desde móvil.
 """
 
-import pyshark
+from scapy.all import AsyncSniffer, IP, IPv6, TCP, Raw
+import numpy as np
 import pandas as pd
+import csv
 import time
 from datetime import datetime
 import os
 
+try:
+    from numba import njit
+except ImportError:  # numba es opcional: sin él se usa la ruta pandas
+    njit = None
+
+# Columnas extraídas de cada paquete y su dtype (una array por columna)
+PACKET_FIELDS = {
+    'timestamp': np.float64,
+    'length': np.int32,
+    'src_port': np.uint16,
+    'dst_port': np.uint16,
+    'tcp_flags': np.uint16,
+    'seq_num': np.uint32,
+    'ack_num': np.uint32,
+    'src_ip': object,
+    'dst_ip': object,
+    'ttl': np.uint8,
+    'tls_header': np.uint64,  # primeros 5 bytes del payload TCP (0 si es más corto)
+}
+
+# Columnas del CSV de salida, en el mismo orden que las capturas previas
+CSV_COLUMNS = [
+    'timestamp', 'quality_setting', 'expected_bitrate', 'protocol', 'length', 'PC',
+    'src_port', 'dst_port', 'tcp_flags', 'seq_num', 'ack_num', 'src_ip', 'dst_ip',
+    'ttl', 'is_spotify_tls', 'tls_record_length', 'iat', 'second', 'throughput_kbps',
+]
+
+# Capacidad inicial de las arrays de captura (se duplica al llenarse)
+INITIAL_CAPACITY = 1 << 16
+
+# Columnas que necesita save_summary
+SUMMARY_COLUMNS = [
+    'timestamp', 'quality_setting', 'expected_bitrate', 'length', 'iat', 'throughput_kbps',
+]
+
+# Tamaño del buffer de escritura del CSV
+CSV_BUFFER_SIZE = 1 << 20
+
+def _aggregate_per_second(ts, length, prev_ts):
+    """
+    Calcula IAT y throughput (kbps) por paquete en una sola pasada.
+    
+    Requiere 'ts' ordenado: los paquetes de un mismo segundo son contiguos, así
+    que al cambiar de segundo se rellena el throughput del tramo anterior.
+    'prev_ts' es el timestamp del paquete anterior al bloque (NaN si no hay).
+    """
+    n = ts.shape[0]
+    iat = np.empty(n, np.float64)
+    throughput = np.empty(n, np.float64)
+    if n == 0:
+        return iat, throughput
+    
+    iat[0] = ts[0] - prev_ts
+    start = 0
+    cur_sec = int(ts[0])
+    bucket_bytes = 0
+    for i in range(n):
+        if i > 0:
+            iat[i] = ts[i] - ts[i - 1]
+        sec = int(ts[i])
+        if sec != cur_sec:
+            throughput[start:i] = bucket_bytes * 8 / 1000
+            start = i
+            cur_sec = sec
+            bucket_bytes = 0
+        bucket_bytes += length[i]
+    throughput[start:n] = bucket_bytes * 8 / 1000
+    
+    return iat, throughput
+
+
+if njit is not None:
+    _aggregate_per_second = njit(cache=True)(_aggregate_per_second)
+
+
+def _warm_up_aggregate():
+    """
+    Compila (o carga de la caché) el kernel numba antes de capturar
+    
+    numba compila en la primera llamada, que si no ocurriría en el callback del
+    sniffer y lo bloquearía ~1 s. Se usan los mismos tipos que calculate_metrics;
+    pandas puede entregar las columnas como vistas de solo lectura, así que se
+    compilan ambas variantes.
+    """
+    for writeable in (True, False):
+        ts = np.zeros(1, dtype=np.float64)
+        length = np.zeros(1, dtype=PACKET_FIELDS['length'])
+        ts.flags.writeable = writeable
+        length.flags.writeable = writeable
+        _aggregate_per_second(ts, length, np.nan)
+
+# Tipos de registro TLS: de change_cipher_spec (0x14) a application_data (0x17)
+TLS_CONTENT_TYPE_MIN = 0x14
+TLS_CONTENT_TYPE_MAX = 0x17
+
+# Flags TCP usados para los números de secuencia relativos
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+
 class SpotifyTrafficCapture:
     def __init__(self, interface='eth0', output_dir='spotify_dataset', device_type='PC'):
         self.interface = interface
         self.output_dir = output_dir
-        self.capture_data = []
+        self.cols = self._alloc_cols(INITIAL_CAPACITY)
+        self.n = 0
+        self.quality_setting = 'Normal'
+        self.filepath = None
+        self.csv_file = None
+        self.rows_written = 0
+        self.head = None
+        self._cur_sec = None
+        self._last_ts = np.nan
+        self._seq_base = {}
+        self.packet_count = 0
+        self.start_time = None
         self.device_type = device_type  # 'PC' o 'Mobile'
         
         # Calidades de Spotify según tu imagen
@@ -39,20 +151,63 @@ class SpotifyTrafficCapture:
         """
         return 'tcp port 443'
     
-    def get_spotify_display_filter(self):
+    @staticmethod
+    def _alloc_cols(capacity):
+        """
+        Reserva una array por columna (Struct-of-Arrays) en lugar de un dict por paquete
+        """
+        return {name: np.empty(capacity, dtype) for name, dtype in PACKET_FIELDS.items()}
+    
+    def _grow_cols(self):
+        """
+        Duplica la capacidad de las arrays cuando se llenan
+        """
+        capacity = 2 * len(self.cols['timestamp'])
+        self.cols = {name: np.resize(col, capacity) for name, col in self.cols.items()}
+    
+    def open_output(self, filename=None):
+        """
+        Abre el CSV de salida y escribe la cabecera; las filas se añaden en streaming
+        """
+        if not filename:
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            filename = f'spotify_traffic_{timestamp}.csv'
+        
+        self.filepath = os.path.join(self.output_dir, filename)
+        self.csv_file = open(self.filepath, 'w', buffering=CSV_BUFFER_SIZE, newline='')
+        csv.writer(self.csv_file, lineterminator='\n').writerow(CSV_COLUMNS)
+        self.rows_written = 0
+        self.head = None
+        self._cur_sec = None
+        self._last_ts = np.nan
+        self._seq_base = {}
+        return self.filepath
+    
+    def close_output(self):
         """
-        Filtro de display: nos quedamos con todo el tráfico TLS (handshake + datos).
-        En esta VM casi todo el TLS:443 será Spotify.
+        Cierra el CSV tras un error de captura; se elimina si solo tiene la cabecera
         """
-        return 'tls'
+        if self.csv_file is None:
+            return
+        if self.rows_written or self.n:
+            self._flush_second()
+        self.csv_file.close()
+        self.csv_file = None
+        if not self.rows_written:
+            os.remove(self.filepath)
     
-    def start_capture(self, duration_seconds=None, quality_setting='Normal'):
+    def start_capture(self, duration_seconds=None, quality_setting='Normal', filename=None):
         """
         Inicia la captura de tráfico
         
+        Los paquetes se escriben en el CSV al cerrarse cada segundo, con un
+        segundo de margen para los que llegan desordenados; en memoria solo se
+        mantienen los dos últimos segundos.
+        
         Args:
             duration_seconds: Duración de la captura (None = hasta interrupción manual)
             quality_setting: Calidad configurada en Spotify
+            filename: Nombre del CSV de salida (None = spotify_traffic_<fecha>.csv)
         """
         print(f"[{datetime.now()}] Iniciando captura...")
         print(f"Calidad configurada: {quality_setting}")
@@ -61,135 +216,281 @@ class SpotifyTrafficCapture:
         print(f"Dispositivo: {self.device_type} (PC=1, Mobile=0 en la columna 'PC')")
         print("\n⚠️  IMPORTANTE: Inicia la reproducción en Spotify AHORA\n")
         
-        bpf_filter = self.get_spotify_capture_filter()
-        display_filter = self.get_spotify_display_filter()
+        self.quality_setting = quality_setting
+        self.packet_count = 0
+        self.open_output(filename)
+        print(f"Guardando en: {self.filepath}\n")
+        if njit is not None:
+            _warm_up_aggregate()
+        self.start_time = time.time()
         
+        # AsyncSniffer disecciona en scapy sin lanzar tshark; store=False evita
+        # retener los paquetes, solo guardamos la tupla de campos
+        sniffer = AsyncSniffer(
+            iface=self.interface,
+            filter=self.get_spotify_capture_filter(),
+            prn=self._on_pkt,
+            store=False
+        )
         try:
-            capture = pyshark.LiveCapture(
-                interface=self.interface,
-                bpf_filter=bpf_filter,
-                display_filter=display_filter
-            )
+            sniffer.start()
+            try:
+                sniffer.join(timeout=duration_seconds)
+            except KeyboardInterrupt:
+                print("\n[!] Captura detenida por el usuario")
             
-            start_time = time.time()
-            packet_count = 0
-            
-            for packet in capture.sniff_continuously():
-                try:
-                    packet_count += 1
-                    
-                    # Extraer información del paquete
-                    packet_info = self.extract_packet_info(packet, quality_setting)
-                    
-                    if packet_info:
-                        self.capture_data.append(packet_info)
-                    
-                    # Mostrar progreso cada 100 paquetes
-                    if packet_count % 100 == 0:
-                        elapsed = time.time() - start_time
-                        print(f"Paquetes capturados: {packet_count} | Tiempo: {elapsed:.1f}s")
-                    
-                    # Detener si se alcanza la duración
-                    if duration_seconds and (time.time() - start_time) >= duration_seconds:
-                        break
-                        
-                except AttributeError:
-                    # Paquete sin la información necesaria
-                    continue
-                    
-        except KeyboardInterrupt:
-            print("\n[!] Captura detenida por el usuario")
-        
-        print(f"\n✓ Captura finalizada: {len(self.capture_data)} paquetes procesados")
-        return self.capture_data
+            if sniffer.running:
+                sniffer.stop()
+        except BaseException:
+            # Error del sniffer (p.ej. interfaz inexistente): se cierra el CSV y,
+            # si no llegó a escribirse ningún paquete, se borra para que el merge
+            # no lo tome como una sesión
+            self.close_output()
+            raise
+        
+        # Volcar el último segundo (el hilo de captura ya ha terminado)
+        self._flush_second()
+        
+        print(f"\n✓ Captura finalizada: {self.rows_written} paquetes procesados")
+        return self.rows_written
     
-    def extract_packet_info(self, packet, quality_setting):
+    def _on_pkt(self, packet):
+        """
+        Callback de AsyncSniffer: se ejecuta en el hilo de captura por cada paquete
+        """
+        self.packet_count += 1
+        
+        self.extract_packet_info(packet)
+        
+        # Mostrar progreso cada 100 paquetes
+        if self.packet_count % 100 == 0:
+            elapsed = time.time() - self.start_time
+            print(f"Paquetes capturados: {self.packet_count} | Tiempo: {elapsed:.1f}s")
+    
+    def extract_packet_info(self, packet):
         """
         Extrae información relevante del paquete para QoE/QoS
+        
+        Escribe los campos de PACKET_FIELDS directamente en la fila self.n de
+        self.cols. Devuelve False si el paquete no lleva datos TCP (equivalente
+        al antiguo display filter 'tls': los ACK puros no forman parte del
+        tráfico TLS).
         """
-        try:
-            packet_data = {
-                'timestamp': float(packet.sniff_timestamp),
-                'quality_setting': quality_setting,
-                'expected_bitrate': self.quality_levels[quality_setting]['bitrate'],
-                'protocol': packet.highest_layer,
-                'length': int(packet.length),
-                # NUEVA COLUMNA: PC (1 = PC/VM, 0 = móvil)
-                'PC': 1 if self.device_type == 'PC' else 0,
-            }
-            
-            # Información TCP
-            if hasattr(packet, 'tcp'):
-                packet_data.update({
-                    'src_port': int(packet.tcp.srcport),
-                    'dst_port': int(packet.tcp.dstport),
-                    'tcp_flags': packet.tcp.flags,
-                    'seq_num': int(packet.tcp.seq),
-                    'ack_num': int(packet.tcp.ack) if hasattr(packet.tcp, 'ack') else None,
-                })
-            
-            # Información IP
-            if hasattr(packet, 'ip'):
-                packet_data.update({
-                    'src_ip': packet.ip.src,
-                    'dst_ip': packet.ip.dst,
-                    'ttl': int(packet.ip.ttl),
-                })
-            
-            # Información TLS (Spotify usa HTTPS)
-            if hasattr(packet, 'tls'):
-                packet_data['is_spotify_tls'] = True
-                if hasattr(packet.tls, 'record_length'):
-                    packet_data['tls_record_length'] = int(packet.tls.record_length)
-            
-            return packet_data
-            
-        except Exception:
-            return None
+        if TCP not in packet:
+            return False
+        tcp = packet[TCP]
+        
+        if IP in packet:
+            ip = packet[IP]
+            ttl = ip.ttl
+        elif IPv6 in packet:
+            ip = packet[IPv6]
+            ttl = ip.hlim
+        else:
+            return False
+        
+        # El SYN no se guarda, pero fija el número de secuencia inicial del
+        # flujo para los valores relativos (como hace tshark)
+        if tcp.flags & TCP_SYN:
+            self._seq_base[(ip.src, tcp.sport, ip.dst, tcp.dport)] = tcp.seq
+        
+        payload = tcp.payload
+        if not isinstance(payload, Raw):
+            return False
+        data = payload.load
+        
+        # Posible cabecera de registro TLS; se interpreta en build_dataframe
+        tls_header = int.from_bytes(data[:5], 'big') if len(data) >= 5 else 0
+        
+        ts = float(packet.time)
+        sec = int(ts)
+        # Los timestamps pueden llegar algo desordenados (RX/TX): se mantiene un
+        # segundo de margen y solo se vuelcan los segundos anteriores a sec - 1
+        if self._cur_sec is None or sec > self._cur_sec:
+            if self._cur_sec is not None:
+                self._flush_second(before=sec - 1)
+            self._cur_sec = sec
+        
+        if self.n == len(self.cols['timestamp']):
+            self._grow_cols()
+        
+        i = self.n
+        cols = self.cols
+        cols['timestamp'][i] = ts
+        cols['length'][i] = len(packet)
+        cols['src_port'][i] = tcp.sport
+        cols['dst_port'][i] = tcp.dport
+        cols['tcp_flags'][i] = int(tcp.flags)
+        cols['seq_num'][i] = tcp.seq
+        cols['ack_num'][i] = tcp.ack
+        cols['src_ip'][i] = ip.src
+        cols['dst_ip'][i] = ip.dst
+        cols['ttl'][i] = ttl
+        cols['tls_header'][i] = tls_header
+        self.n = i + 1
+        
+        return True
+    
+    def _flush_second(self, before=None):
+        """
+        Calcula las métricas de los segundos acumulados y los añade al CSV
+        
+        Con 'before' solo se vuelcan los paquetes con timestamp < before; el
+        resto se queda en las arrays para el siguiente bloque. Sin él se vuelca todo.
+        """
+        if self.n == 0:
+            return
+        
+        rows = None
+        if before is not None:
+            rows = self.cols['timestamp'][:self.n] < before
+            n_rows = int(rows.sum())
+            if n_rows == 0:
+                return
+            if n_rows == self.n:
+                rows = None
+        
+        df = self.calculate_metrics(self.build_dataframe(rows), prev_timestamp=self._last_ts)
+        df.to_csv(self.csv_file, header=False, index=False)
+        
+        if self.head is None:
+            self.head = df.head()
+        self.rows_written += len(df)
+        self._last_ts = df['timestamp'].iat[-1]
+        
+        if rows is None:
+            self.n = 0
+        else:
+            # Compacta al principio los paquetes que siguen pendientes
+            keep = ~rows
+            n_keep = self.n - len(df)
+            for col in self.cols.values():
+                col[:n_keep] = col[:self.n][keep]
+            self.n = n_keep
+    
+    def build_dataframe(self, rows=None):
+        """
+        Construye el DataFrame con el mismo orden de columnas que las capturas previas
+        
+        'rows' es una máscara opcional sobre las self.n filas acumuladas.
+        """
+        if rows is None:
+            df = pd.DataFrame({name: col[:self.n] for name, col in self.cols.items()})
+        else:
+            df = pd.DataFrame({name: col[:self.n][rows] for name, col in self.cols.items()})
+        self._relative_seq_ack(df)
+        df['tcp_flags'] = np.char.mod('0x%04x', df['tcp_flags'].to_numpy())
+        
+        # Cabecera de registro TLS: tipo (1B), versión 0x03xx (2B), longitud (2B).
+        # Se decodifica de una vez para todo el bloque en lugar de por paquete.
+        header = df.pop('tls_header').to_numpy()
+        content_type = header >> 32
+        is_record = ((content_type >= TLS_CONTENT_TYPE_MIN)
+                     & (content_type <= TLS_CONTENT_TYPE_MAX)
+                     & (((header >> 24) & 0xff) == 0x03))
+        df['tls_record_length'] = np.where(is_record, header & 0xffff, np.nan)
+        
+        df.insert(1, 'quality_setting', self.quality_setting)
+        df.insert(2, 'expected_bitrate', self.quality_levels[self.quality_setting]['bitrate'])
+        df.insert(3, 'protocol', 'TLS')
+        # NUEVA COLUMNA: PC (1 = PC/VM, 0 = móvil)
+        df.insert(5, 'PC', 1 if self.device_type == 'PC' else 0)
+        df.insert(len(df.columns) - 1, 'is_spotify_tls', True)
+        return df
+    
+    def _relative_seq_ack(self, df):
+        """
+        Pasa seq_num/ack_num a valores relativos por flujo, como los exporta tshark
+        
+        La base de cada sentido del flujo es el ISN si se vio el SYN; si no, el
+        primer seq visto (o el primer ack del sentido contrario) menos 1, de modo
+        que el primer byte de datos vale 1. Las bases se mantienen entre bloques.
+        """
+        flows = pd.MultiIndex.from_arrays(
+            [df['src_ip'], df['src_port'], df['dst_ip'], df['dst_port']])
+        codes, uniques = pd.factorize(flows)
+        first_rows = np.unique(codes, return_index=True)[1]
+        
+        seq = df['seq_num'].to_numpy().astype(np.int64)
+        ack = df['ack_num'].to_numpy().astype(np.int64)
+        seq_base = np.empty(len(uniques), dtype=np.int64)
+        ack_base = np.empty(len(uniques), dtype=np.int64)
+        # Bucle por flujo (pocos), no por paquete
+        for j, (flow, row) in enumerate(zip(uniques, first_rows)):
+            src, sport, dst, dport = flow
+            seq_base[j] = self._seq_base.setdefault(flow, seq[row] - 1)
+            # El ack de un sentido se mide respecto al ISN del otro
+            ack_base[j] = self._seq_base.setdefault((dst, dport, src, sport), ack[row] - 1)
+        
+        df['seq_num'] = ((seq - seq_base[codes]) % 2**32).astype(np.uint32)
+        has_ack = (df['tcp_flags'].to_numpy() & TCP_ACK) != 0
+        df['ack_num'] = np.where(has_ack, (ack - ack_base[codes]) % 2**32, 0).astype(np.uint32)
     
     def save_dataset(self, filename=None):
         """
-        Guarda los datos capturados en formato CSV
+        Cierra el CSV generado durante la captura y guarda el resumen
+        
+        Si se indica 'filename', el CSV se renombra a ese nombre.
         """
-        if not filename:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f'spotify_traffic_{timestamp}.csv'
+        if self.csv_file is None:
+            print("⚠️  No hay datos para guardar")
+            return None
         
-        filepath = os.path.join(self.output_dir, filename)
+        self._flush_second()
+        self.csv_file.close()
+        self.csv_file = None
         
-        df = pd.DataFrame(self.capture_data)
+        filepath = self.filepath
+        if filename:
+            filepath = os.path.join(self.output_dir, filename)
+            os.replace(self.filepath, filepath)
+            self.filepath = filepath
         
-        if not df.empty:
-            # Calcular métricas agregadas
-            df = self.calculate_metrics(df)
-            df.to_csv(filepath, index=False)
+        if self.rows_written:
             print(f"\n✓ Dataset guardado: {filepath}")
-            print(f"  Total registros: {len(df)}")
+            print(f"  Total registros: {self.rows_written}")
             print(f"\nPrimeras filas del dataset:")
-            print(df.head())
+            print(self.head)
             
-            # Guardar resumen estadístico
+            # Guardar resumen estadístico (solo se releen las columnas necesarias)
+            df = pd.read_csv(filepath, usecols=SUMMARY_COLUMNS)
             self.save_summary(df, filepath.replace('.csv', '_summary.txt'))
         else:
+            os.remove(filepath)
             print("⚠️  No hay datos para guardar")
         
         return filepath
     
-    def calculate_metrics(self, df):
+    def calculate_metrics(self, df, prev_timestamp=np.nan):
         """
         Calcula métricas de QoS relevantes según el paper
+        
+        'prev_timestamp' es el último timestamp ya escrito, para que el IAT del
+        primer paquete del bloque sea continuo con el bloque anterior.
         """
-        # Ordenar por timestamp
-        df = df.sort_values('timestamp')
+        # Los paquetes llegan en orden de captura; solo se ordena si no lo están
+        if not df['timestamp'].is_monotonic_increasing:
+            df = df.sort_values('timestamp', kind='mergesort')
+        
+        ts = df['timestamp'].to_numpy()
+        
+        if njit is not None:
+            # IAT y throughput por segundo en un único bucle compilado
+            iat, throughput = _aggregate_per_second(
+                ts, df['length'].to_numpy(), prev_timestamp)
+            df['iat'] = iat
+            df['second'] = np.floor(ts).astype(np.int64)
+            df['throughput_kbps'] = throughput
+            return df
         
         # Calcular intervalos entre paquetes (IAT - Inter Arrival Time)
-        df['iat'] = df['timestamp'].diff()
+        df['iat'] = np.diff(ts, prepend=prev_timestamp)
         
         # Throughput por ventana de tiempo (cada segundo)
-        df['second'] = df['timestamp'].astype(int)
+        df['second'] = np.floor(ts).astype(np.int64)
         throughput = df.groupby('second')['length'].sum() * 8 / 1000  # kbps
-        df = df.merge(throughput.rename('throughput_kbps'), 
-                      left_on='second', right_index=True, how='left')
+        # 'second' es una clave entera: map evita el merge (y la copia del frame)
+        df['throughput_kbps'] = df['second'].map(throughput)
         
         return df
     
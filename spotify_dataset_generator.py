@@ -1,7 +1,16 @@
 import time
-import csv
 import os
-from scapy.all import sniff, wrpcap
+import gc
+import select
+import socket
+import struct
+import threading
+from array import array
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from scapy.all import conf, RawPcapWriter
+from scapy.data import SO_TIMESTAMPNS
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from dotenv import load_dotenv
@@ -14,6 +23,12 @@ SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI")
 CAPTURE_DURATION = 15  # seconds
+CAPTURE_FILTER = "tcp port 443"
+SNAPLEN = 96  # bytes kept per frame (link + IP + TCP headers)
+CAPTURE_RCVBUF = 16 * 1024 * 1024  # kernel socket buffer, absorbs bursts
+CAPTURE_PRIORITY = 50  # SCHED_FIFO priority of the capture thread
+# Room for the SO_TIMESTAMPNS timespec and the PACKET_AUXDATA record
+ANCILLARY_BUFSIZE = socket.CMSG_SPACE(16) + socket.CMSG_SPACE(32)
 
 # List of song URIs to capture (replace with your test songs)
 SONG_URIS = [
@@ -32,9 +47,12 @@ STREAMING_QUALITY = [
 
 class SpotifyDatasetGenerator:
     def __init__(self, audio_quality, interface="ens33"):
-        self.driver = None
         self.spotify_client = None
-        self.captured_data = []
+        self.device_id = None
+        self.current_times = array('d')
+        self.current_sizes = array('I')
+        self._stop_capture = threading.Event()
+        self._capture_error = None
         self.interface = interface
         self.dataset_dir = 'dataset'
         self.pcap_captures_dir = 'pcap'
@@ -57,47 +75,130 @@ class SpotifyDatasetGenerator:
         ))
         print("    Spotify client authenticated")
     
-    def packet_callback(self, packet):
-        """Callback function for packet capture"""
-        arrival_time = packet.time
-        payload_size = len(packet)
-        self.current_capture.append((arrival_time, payload_size))
+    def select_playback_device(self):
+        """Pick the Spotify Connect device to play on (the active one if any)"""
+        devices = self.spotify_client.devices().get('devices', [])
+        if not devices:
+            return False
+        device = next((d for d in devices if d.get('is_active')), devices[0])
+        self.device_id = device['id']
+        print(f"    Using device: {device['name']} ({device['type']})")
+        return True
+    
+    def open_capture_socket(self):
+        """Open an AF_PACKET socket with the BPF filter attached in the kernel"""
+        # scapy compiles the filter with pcap_compile(optimize=1)
+        sock = conf.L2listen(iface=self.interface, filter=CAPTURE_FILTER)
+        # A larger receive buffer keeps the kernel from dropping frames while
+        # the capture thread is descheduled (capped by net.core.rmem_max)
+        sock.ins.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, CAPTURE_RCVBUF)
+        return sock
+    
+    def prioritize_capture_thread(self, thread):
+        """Run the capture thread with real-time priority on its own CPU"""
+        # Best effort: needs CAP_SYS_NICE, otherwise the defaults are kept
+        try:
+            os.sched_setscheduler(thread.native_id, os.SCHED_FIFO, os.sched_param(CAPTURE_PRIORITY))
+        except OSError as e:
+            print(f"   Could not raise capture thread priority: {e}")
+        cpus = os.sched_getaffinity(0)
+        if len(cpus) > 1:
+            os.sched_setaffinity(thread.native_id, {max(cpus)})
+    
+    def capture_loop(self, sock, pcap_writer):
+        """Read raw frames until stopped; packets are never dissected by scapy"""
+        # Frames are truncated to SNAPLEN; MSG_TRUNC still reports the
+        # on-wire length, which is what gets recorded as the packet size.
+        # The arrival time is the kernel receive timestamp (SO_TIMESTAMPNS,
+        # enabled by scapy's listen socket), not the time the loop woke up
+        recvmsg_into = sock.ins.recvmsg_into
+        frame = bytearray(SNAPLEN)
+        buffers = [frame]
+        write_frame = pcap_writer.write_packet
+        times_append = self.current_times.append
+        sizes_append = self.current_sizes.append
+        try:
+            while not self._stop_capture.is_set():
+                if not select.select([sock.ins], [], [], 0.1)[0]:
+                    continue
+                wirelen, ancdata, _, _ = recvmsg_into(buffers, ANCILLARY_BUFSIZE, socket.MSG_TRUNC)
+                for level, kind, data in ancdata:
+                    if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                        sec, nsec = struct.unpack("ll", data)
+                        break
+                else:
+                    sec, nsec = divmod(time.time_ns(), 1_000_000_000)
+                times_append(sec + nsec * 1e-9)
+                sizes_append(wirelen)
+                # Stream the raw frame straight to the pcap (nothing retained);
+                # sec/usec are passed as integers so scapy keeps the fraction
+                caplen = min(wirelen, SNAPLEN)
+                write_frame(bytes(frame[:caplen]), sec=sec, usec=nsec // 1000, caplen=caplen, wirelen=wirelen)
+        except Exception as e:
+            # Surfaced by capture_song_traffic instead of threading.excepthook
+            self._capture_error = e
+            self._stop_capture.set()
     
     def capture_song_traffic(self, song_uri, song_index):
         """Capture network traffic for a specific song"""
         print(f"Capturing traffic for song {song_index + 1}/{len(SONG_URIS)}...")
         
-        # Start playback using Spotipy
-        try:
-            self.spotify_client.start_playback(uris=[song_uri])
-            print(f"Started playback: {song_uri}")
-        except Exception as e:
-            print(f"Error starting playback: {e}")
-            print("Attempting to continue with current playback...")
-        
-        # Initialize capture list for this song
-        self.current_capture = []
-        
-        # Start packet sniffing
-        print(f"   Sniffing packets for {CAPTURE_DURATION} seconds...")
+        # Initialize capture buffers for this song (no per-packet tuples)
+        self.current_times = array('d')
+        self.current_sizes = array('I')
+
         try:
-            captured_packets = sniff(
-                iface=self.interface,
-                filter="tcp port 443",
-                prn=self.packet_callback,
-                timeout=CAPTURE_DURATION,
-                store=True
-            )
-
-            wrpcap(f"{self.pcap_captures_dir}/{time.strftime("%d-%m-%Y-%H%M%S")}_{song_uri}_{self.audio_quality}.pcap", captured_packets)
+            sock = self.open_capture_socket()
         except PermissionError:
             print("ERROR: Permission denied. Please run script with sudo/admin privileges")
             raise
+
+        # Pcap writer opened once per song; frames are written as they arrive
+        try:
+            linktype = conf.l2types.layer2num.get(sock.LL, 1)
+            pcap_writer = RawPcapWriter(f"{self.pcap_captures_dir}/{time.strftime("%d-%m-%Y-%H%M%S")}_{song_uri}_{self.audio_quality}.pcap", linktype=linktype, snaplen=SNAPLEN, sync=False)
+            pcap_writer.write_header(None)
+        except BaseException:
+            sock.close()
+            raise
+
+        # Start capturing before playback so the first packets are not missed
+        # GC pauses are deferred until the capture window is over
+        self._stop_capture.clear()
+        self._capture_error = None
+        capture_thread = threading.Thread(target=self.capture_loop, args=(sock, pcap_writer), daemon=True)
+        gc.disable()
+        try:
+            capture_thread.start()
+            self.prioritize_capture_thread(capture_thread)
+
+            # Start playback using Spotipy while the capture is already running
+            try:
+                self.spotify_client.start_playback(device_id=self.device_id, uris=[song_uri])
+                print(f"Started playback: {song_uri}")
+            except Exception as e:
+                print(f"Error starting playback: {e}")
+                print("Attempting to continue with current playback...")
+            
+            print(f"   Sniffing packets for {CAPTURE_DURATION} seconds...")
+            # Returns early if the capture thread fails
+            self._stop_capture.wait(CAPTURE_DURATION)
+        finally:
+            # Runs on Ctrl-C too, so the pcap is always flushed
+            self._stop_capture.set()
+            if capture_thread.is_alive():
+                capture_thread.join()
+            gc.enable()
+            sock.close()
+            pcap_writer.close()
+            # A failed capture must not be saved as if it were complete
+            if self._capture_error is not None:
+                raise self._capture_error
         
-        print(f"    Captured {len(self.current_capture)} packets")
+        print(f"    Captured {len(self.current_times)} packets")
         
         # Store the capture
-        return self.current_capture.copy()
+        return self.current_times, self.current_sizes
     
     def save_dataset(self, new_data):
         """Save or append data to CSV file"""
@@ -106,32 +207,36 @@ class SpotifyDatasetGenerator:
         # Check if file exists to determine if we need headers
         file_exists = os.path.exists(self.dataset_file)
         
+        if not file_exists:
+            print("   Creating new dataset file with headers")
+        else:
+            print(f"   Appending to existing dataset")
+        
+        # Build the columns for all songs at once; the capture arrays are
+        # viewed as numpy buffers without copying
+        song_ids = np.repeat(np.array(SONG_URIS[:len(new_data)], dtype=object),
+                             [len(times) for times, _ in new_data])
+        times = np.concatenate([np.frombuffer(t, dtype=np.float64) for t, _ in new_data])
+        sizes = np.concatenate([np.frombuffer(s, dtype=np.uint32) for _, s in new_data])
+        table = pa.table({
+            'song_id': pa.array(song_ids, type=pa.string()),
+            'packet_arrival_time': times,
+            'payload_size': sizes
+        })
+        
+        # Same layout csv.writer produced: no quoting, CRLF line endings
+        write_options = pa_csv.WriteOptions(
+            include_header=not file_exists,
+            eol='\r\n',
+            quoting_style='none',
+            quoting_header='none'
+        )
+        
         # Open CSV file in append mode
-        with open(self.dataset_file, 'a', newline='') as f:
-            writer = csv.writer(f)
-            
-            # Write headers if new file
-            if not file_exists:
-                writer.writerow(['song_id', 'packet_arrival_time', 'payload_size'])
-                print("   Creating new dataset file with headers")
-            else:
-                print(f"   Appending to existing dataset")
-            
-            # Write data for each song
-            total_packets = 0
-            
-            for song_idx, song_capture in enumerate(new_data):
-                song_id = SONG_URIS[song_idx]
-                
-                for arrival_time, payload_size in song_capture:
-                    writer.writerow([
-                        song_id,
-                        arrival_time,
-                        payload_size
-                    ])
-                    total_packets += 1
+        with open(self.dataset_file, 'ab') as f:
+            pa_csv.write_csv(table, f, write_options=write_options)
         
-        print(f"    Saved {total_packets} packets from {len(new_data)} songs")
+        print(f"    Saved {table.num_rows} packets from {len(new_data)} songs")
         print(f"    File: {self.dataset_file}")
     
     def generate_dataset(self):
@@ -139,6 +244,9 @@ class SpotifyDatasetGenerator:
         try:
             # Setup
             self.setup_spotify_client()
+            if not self.select_playback_device():
+                print("ERROR: No Spotify Connect device found. Open Spotify on a device and try again")
+                return
             
             # Capture data for each song
             captured_songs = []
@@ -152,8 +260,8 @@ class SpotifyDatasetGenerator:
             print("\n" + "="*50)
             print("Dataset generation complete!")
             print(f"Total songs captured: {len(captured_songs)}")
-            for i, song_data in enumerate(captured_songs):
-                print(f"  Song {i+1}: {len(song_data)} packets")
+            for i, (times, _) in enumerate(captured_songs):
+                print(f"  Song {i+1}: {len(times)} packets")
             print("="*50)
             
         except KeyboardInterrupt: